@@ -1,8 +1,37 @@
 from .stockdata import *
+from .stockdata import njit
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import scipy as sp
+import warnings
+
+try:
+  import quadprog
+except ImportError:
+  quadprog = None
+
+@njit(cache=True, error_model='numpy')
+def fobj_robust(w, mu, C, sigma):
+  """Negative Sharpe ratio with box uncertainty in mean"""
+  return -(w @ mu - np.abs(w) @ sigma) / np.sqrt(w @ C @ w)
+
+@njit(cache=True, error_model='numpy')
+def jac_robust(w, mu, C, sigma):
+  """Analytic gradient of fobj_robust"""
+  Cw = C @ w
+  s = np.sqrt(w @ Cw)
+  return -(mu - np.sign(w) * sigma) / s + (w @ mu - np.abs(w) @ sigma) * Cw / s**3
+
+@njit(cache=True)
+def fcon_budget(w):
+  """Budget constraint (equality): sum of weights - 1 = 0"""
+  return w.sum() - 1
+
+@njit(cache=True)
+def jac_budget(w):
+  """Gradient of fcon_budget"""
+  return np.ones_like(w)
 
 class Portfolio(StockData):
   """Class for each portfolio weight according to window sizes
@@ -28,7 +57,24 @@ class Portfolio(StockData):
   """
   def __init__(self, data):
     super().__init__(data)
+    # Constraint spec shared by every SLSQP call of the backtest
+    self._budget_cons = [dict(type='eq', fun=fcon_budget, jac=jac_budget)]
+    self._equal_w = np.full(self.ret.shape[1], 1.0 / self.ret.shape[1])
+    self._equal_w.flags.writeable = False
     
+  def get_observed_moments(self, when : int):
+    """Get mean and covariance of returns until the input time restricted to get_observed stocks
+
+    Args:
+      when: the last timestamp of the window
+
+    Return:
+      observed mask, mean vector and covariance matrix of observed stocks
+    """
+    observed = self.get_observed(when)
+    returns, covariance = self.get_moments(when)
+    return observed, returns[observed], covariance[np.ix_(observed, observed)]
+
   def value_weight(self, when :int):
     """value-weight portfolio
     Weight is proportional to the size (= prc x shrout)
@@ -37,9 +83,10 @@ class Portfolio(StockData):
       when: the last timestamp of the window
 
     Return:
-      dataframe of value-weight
+      array of value-weight (NaN for stocks without market cap at that time)
     """
-    return self.mktcap.loc[self.date_index[when]] / self.mktcap.loc[self.date_index[when]].sum()
+    row = self._mktcap_values[when]
+    return row / np.nansum(row)
 
   def equal_weight(self, when : int):
     """equal-weight portfolio
@@ -48,9 +95,9 @@ class Portfolio(StockData):
       when: the last timestamp of the window
 
     Return:
-      dataframe of equal-weight
+      array of equal-weight (read-only)
     """
-    return np.ones_like(self.ret.loc[self.date_index[when]]) / self.ret.shape[1]
+    return self._equal_w
   
   def mean_variance(self, when : int):
     """mean-variance (tangent) portfolio
@@ -59,27 +106,19 @@ class Portfolio(StockData):
       when: the last timestamp of the window
 
     Return:
-      dataframe of weight of mean-variance portfolio
+      dataframe of weight of mean-variance portfolio; zero for stocks not in get_observed
     """
-    ret_window = self.get_ret_til(when)
-    returns = ret_window.mean(axis=0).values
-    covariance = ret_window.cov().values
-
-    e = np.ones_like(returns)
+    returns, _ = self.get_moments(when)
 
-    # Objective function
-    def fobj(w, mu, C): return -(w @ mu) /  np.sqrt(w.T @ C @ w)
+    # Closed form of the tangent portfolio: w proportional to C^-1 mu
+    weight = self.solve_covariance(when, returns)
 
-    # Budget constraint (equality)
-    def fcon_budget(w): return w.sum() - 1 # = 0
-
-    cons = [dict(type='eq', fun=fcon_budget)]
-
-    w0 = e / len(e) # Initial guess
-    
-    res = sp.optimize.minimize(fobj, w0, args=(returns, covariance),  constraints = cons, options={'maxiter':5000})
-
-    weight = res.x
+    # With 1'C^-1 mu <= 0 no budget-feasible portfolio attains the maximum Sharpe ratio;
+    # normalising then yields the minimum Sharpe ratio portfolio instead
+    if weight.sum() <= 0:
+      warnings.warn(f"tangent portfolio does not exist at {self.date_index[when]} (1'C^-1 mu <= 0); "
+                    "returned weights have the lowest Sharpe ratio", RuntimeWarning)
+    weight = weight / weight.sum()
 
     return weight
   
@@ -90,32 +129,44 @@ class Portfolio(StockData):
       when: the last timestamp of the window
 
     Return:
-      dataframe of weight of mean-variance portfolio with short-sale constraint weight
+      dataframe of weight of mean-variance portfolio with short-sale constraint weight; zero for stocks not in get_observed
     """
-    ret_window = self.get_ret_til(when)
-    returns = ret_window.mean(axis=0).values
-    covariance = ret_window.cov().values
-
-    e = np.ones_like(returns)
-
-    # Objective function
-    def fobj(w, mu, C): return -(w @ mu) /  np.sqrt(w.T @ C @ w)
-
-    # Budget constraint (equality)
-    def fcon_budget(w): return w.sum() - 1 # = 0
-
-    cons = [dict(type='eq', fun=fcon_budget)]
-
-    w0 = e / len(e) # Initial guess
-
-    # Bounds
-    bounds = sp.optimize.Bounds(0 * e)
-    
-    res = sp.optimize.minimize(fobj, w0, args=(returns, covariance),  constraints = cons, bounds=bounds, options={'maxiter':5000})
-
-    weight = res.x
-
-    return weight
+    observed, returns, covariance = self.get_observed_moments(when)
+    if not observed.any():
+      return np.full(len(observed), np.nan)
+
+    N = len(returns)
+    full_weight = np.zeros(len(observed))
+
+    # Without a stock of positive mean the QP is infeasible; the best long-only Sharpe ratio is then
+    # that of the single stock with the highest mu / sigma
+    if returns.max() <= 0:
+      warnings.warn(f"no stock has a positive mean return until {self.date_index[when]}; "
+                    "returned the single stock with the highest Sharpe ratio", RuntimeWarning)
+      full_weight[np.flatnonzero(observed)[np.argmax(returns / np.sqrt(np.diag(covariance)))]] = 1
+      return full_weight
+
+    # Convex QP equivalent to the Sharpe ratio maximisation:
+    # min w'Cw  s.t.  mu'w = 1, w >= 0  (then rescale to the budget)
+    if quadprog is not None and self.get_cho_factor(when) is not None:
+      A = np.vstack([returns, np.eye(N)]).T
+      b = np.concatenate([[1.], np.zeros(N)])
+      # clip round-off below zero on bound-active stocks
+      weight = np.maximum(quadprog.solve_qp(covariance, np.zeros(N), A, b, meq=1)[0], 0)
+
+    else:
+      # Same tangent portfolio as non-negative least squares (Britten-Jones): min ||1 - R u||^2 s.t. u >= 0,
+      # expressed through the second moment M = A'A = C + mu mu' (any positive scaling of C gives the same
+      # portfolio) and solved by the Lawson-Hanson active set. The eigendecomposition also covers singular C.
+      lam, Q = np.linalg.eigh(covariance + np.outer(returns, returns))
+      keep = lam > lam.max() * 1e-12
+      A = np.sqrt(lam[keep])[:, None] * Q[:, keep].T
+      b = (Q[:, keep].T @ returns) / np.sqrt(lam[keep])
+      weight, _ = sp.optimize.nnls(A, b)
+
+    full_weight[observed] = weight / weight.sum()
+
+    return full_weight
   
   def min_var(self, when : int):
     """minimun-variance portfolio
@@ -124,14 +175,10 @@ class Portfolio(StockData):
       when: the last timestamp of the window
 
     Return:
-      dataframe of weight of minimum-variance portfolio
+      dataframe of weight of minimum-variance portfolio; zero for stocks not in get_observed
     """
-    ret_window = self.get_ret_til(when)
-    returns = ret_window.mean(axis=0).values
-    covariance = ret_window.cov().values
-
-    e = np.ones_like(returns)
-    weight = np.linalg.solve(covariance, e)
+    e = np.ones(self._ret_values.shape[1])
+    weight = self.solve_covariance(when, e)
     weight = weight / np.sum(weight)
 
     return weight
@@ -143,26 +190,21 @@ class Portfolio(StockData):
       when: the last timestamp of the window
 
     Return:
-      dataframe of weight of minimum-variance portfolio
+      dataframe of weight of minimum-variance portfolio; zero for stocks not in get_observed
     """
-    ret_window = self.get_ret_til(when)
-    returns = ret_window.mean(axis=0).values
-    covariance = ret_window.cov().values
+    observed, returns, covariance = self.get_observed_moments(when)
+    if not observed.any():
+      return np.full(len(observed), np.nan)
+    sigma = self.get_std(when, ddof=0)[observed]
 
     e = np.ones_like(returns)
-
-    # Objective function - Sharpe Ratio Maximisation with box uncertainty
-    def fobj(w, mu, C): return -(w @ mu - np.abs(w) @ np.std(ret_window, axis=0)) /  np.sqrt(w.T @ C @ w)
-
-    # Budget constraint (equality)
-    def fcon_budget(w): return w.sum() - 1 # = 0
-
-    cons = [dict(type='eq', fun=fcon_budget)]
     
     w0 = e / len(e) # Initial guess
     
-    res = sp.optimize.minimize(fobj, w0, args=(returns, covariance),  constraints = cons, options={'maxiter':5000})
+    # Objective function - Sharpe Ratio Maximisation with box uncertainty
+    res = sp.optimize.minimize(fobj_robust, w0, args=(returns, covariance, sigma), jac=jac_robust, method='SLSQP', constraints = self._budget_cons, options={'maxiter':5000})
 
-    weight = res.x
+    weight = np.zeros(len(observed))
+    weight[observed] = res.x
     
     return weight
\ No newline at end of file
@@ -3,6 +3,41 @@ import numpy as np
 import matplotlib.pyplot as plt
 import scipy as sp
 
+try:
+  from numba import njit
+except ImportError:
+  def njit(*args, **kwargs):
+    return lambda f: f
+
+@njit(cache=True, error_model='numpy')
+def _step(r_prev, r_curr, W_prev, tw, tc):
+  """One rebalancing step: return of target weight tw net of the cost of moving from the drifted weight
+  NaN terms are skipped in every sum, as pandas .sum() does.
+  """
+  N = tw.shape[0]
+  s = 0.0
+  for i in range(N):
+    x = (1.0 + r_prev[i]) * W_prev[i]
+    if x == x:
+      s += x
+
+  ret = 0.0
+  for i in range(N):
+    x = r_curr[i] * tw[i]
+    if x == x:
+      ret += x
+
+  # Nothing is held before the first rebalance, so no transaction cost is charged
+  if s == 0.0:
+    return ret
+
+  diff = 0.0
+  for i in range(N):
+    x = abs(tw[i] - (1.0 + r_prev[i]) * W_prev[i] / s)
+    if x == x:
+      diff += x
+  return ret - diff * tc
+
 class StockData:
   """Class to generate panel data using each columns; ret, prc, shrout
 
@@ -19,11 +54,45 @@ class StockData:
   """
   def __init__(self, data):
     self.data = data
-    self.ret = pd.pivot(self.data, values="ret", index="date", columns="permno")
-    self.prc = pd.pivot(self.data, values="prc", index="date", columns="permno")
-    self.shrout = pd.pivot(self.data, values="shrout", index="date", columns="permno")
-    self.mktcap = self.ret * self.shrout
+    self.ret, self.prc, self.shrout = self.gen_panels(["ret", "prc", "shrout"])
+    self.mktcap = pd.DataFrame(self.prc.values * self.shrout.values, index=self.ret.index, columns=self.ret.columns)
     self.date_index = self.get_datetime_index()
+    self._ret_values = np.ascontiguousarray(self.ret.values)
+    self._ret_values.flags.writeable = False
+    self._mktcap_values = self.mktcap.values
+    self._date_index = self.ret.index
+    self._reset_moments()
+    self._cho_when = -1
+
+  def gen_panels(self, values : list):
+    """Generate (date x permno) panels by scattering each column into a preallocated array
+
+    Args:
+      values: list of column names to reshape
+
+    Returns:
+      list of panel dataframes, one for each column in values
+
+    Raises:
+      ValueError: if a (date, permno) pair appears twice or a date / permno is missing
+    """
+    if self.data.duplicated(["date", "permno"]).any():
+      raise ValueError("Index contains duplicate (date, permno) entries, cannot reshape")
+
+    dates = self.data["date"].astype("category")
+    permnos = self.data["permno"].astype("category")
+    index = pd.Index(dates.cat.categories, name="date")
+    columns = pd.Index(permnos.cat.categories, name="permno")
+    rows, cols = dates.cat.codes.to_numpy(), permnos.cat.codes.to_numpy()
+    if (rows < 0).any() or (cols < 0).any():
+      raise ValueError("date and permno must not be missing")
+
+    panels = []
+    for value in values:
+      panel = np.full((len(index), len(columns)), np.nan)
+      panel[rows, cols] = self.data[value].to_numpy()
+      panels.append(pd.DataFrame(panel, index=index, columns=columns))
+    return panels
 
   def get_datetime_index(self):
     """Get datetime index list used in converting index into datetime
@@ -44,6 +113,143 @@ class StockData:
     """
     return self.ret.loc[:self.date_index[when]]
 
+  def _reset_moments(self):
+    """Reset running sums used by get_moments"""
+    n_assets = self._ret_values.shape[1]
+    self._moments_when = -1
+    self._sum_ret = np.zeros(n_assets)
+    self._count = np.zeros(n_assets)
+    self._sum_outer = np.zeros((n_assets, n_assets))
+    self._sum_cross = np.zeros((n_assets, n_assets))
+    self._count_pair = np.zeros((n_assets, n_assets))
+
+  def get_moments(self, when : int):
+    """Get sample mean and covariance of returns until the input time.
+    Running sums are updated incrementally, so consecutive calls cost O(N^2) instead of re-aggregating the whole window.
+    Missing returns are skipped like DataFrame.mean / DataFrame.cov do (pairwise complete observations).
+
+    Args:
+      when: int of the index which indictaes time.
+
+    Returns:
+      mean vector and covariance matrix (ndarray) of returns until the input time.
+    """
+    if when < self._moments_when:
+      self._reset_moments()
+
+    if when > self._moments_when:
+      # New rows are added in one block; syrk fills only the upper triangle of X'X
+      X = self._ret_values[self._moments_when + 1:when + 1]
+      valid = ~np.isnan(X)
+      X0 = np.where(valid, X, 0.)
+      V = valid.astype(np.float64)
+      XtX = sp.linalg.blas.dsyrk(1.0, X0.T, trans=0, lower=0)
+      self._sum_ret += X0.sum(axis=0)
+      self._count += V.sum(axis=0)
+      self._sum_outer += XtX + np.triu(XtX, 1).T
+      self._sum_cross += X0.T @ V # [i, j]: sum of asset i over rows where asset j is observed
+      self._count_pair += V.T @ V
+    self._moments_when = when
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+      mu = self._sum_ret / self._count
+      C = (self._sum_outer - self._sum_cross * self._sum_cross.T / self._count_pair) / (self._count_pair - 1)
+    return mu, C
+
+  def get_std(self, when : int, ddof : int = 1):
+    """Get standard deviation of each asset's returns until the input time.
+
+    Args:
+      when: int of the index which indictaes time.
+      ddof: delta degrees of freedom; 0 for population std.
+
+    Returns:
+      std vector (ndarray) of returns until the input time.
+    """
+    self.get_moments(when)
+    n_obs = self._count
+    with np.errstate(divide='ignore', invalid='ignore'):
+      return np.sqrt(np.maximum(np.diag(self._sum_outer) - self._sum_ret**2 / n_obs, 0) / (n_obs - ddof))
+
+  def _update_observed(self, when : int):
+    """Recompute observed stocks and Cholesky factor cached for the input time"""
+    _, covariance = self.get_moments(when)
+    # Drop stocks without a defined covariance, the one with most undefined entries first
+    observed = self._count >= 2
+    finite = np.isfinite(covariance)
+    while observed.any():
+      undefined = (~finite[np.ix_(observed, observed)]).sum(axis=1)
+      if undefined.max() == 0:
+        break
+      observed[np.flatnonzero(observed)[undefined.argmax()]] = False
+
+    self._observed = observed
+    self._cho = None
+    if observed.any():
+      try:
+        self._cho = sp.linalg.cho_factor(covariance[np.ix_(observed, observed)], lower=True)
+      except (np.linalg.LinAlgError, ValueError):
+        # not positive definite, or non-finite entries
+        pass
+    self._cho_when = when
+
+  def get_observed(self, when : int):
+    """Get stocks which enter covariance-based portfolios at the input time.
+    A stock is left out while it has fewer than 2 returns in the window or while its covariance with
+    another observed stock is undefined (fewer than 2 joint returns, e.g. a stock listed late).
+
+    Args:
+      when: int of the index which indictaes time.
+
+    Returns:
+      boolean ndarray, True for observed stocks.
+    """
+    if self._cho_when != when:
+      self._update_observed(when)
+    return self._observed
+
+  def get_cho_factor(self, when : int):
+    """Get Cholesky factor of the covariance of observed stocks' returns until the input time.
+    The factor is cached per timestamp so that portfolios sharing a window factorize it only once.
+
+    Args:
+      when: int of the index which indictaes time.
+
+    Returns:
+      cho_factor tuple of the covariance matrix among get_observed stocks, to be used with scipy.linalg.cho_solve.
+      None if that covariance is not positive definite (e.g. window not longer than the number of stocks).
+    """
+    if self._cho_when != when:
+      self._update_observed(when)
+    return self._cho
+
+  def solve_covariance(self, when : int, b):
+    """Solve C x = b for the covariance C of returns until the input time, over observed stocks only.
+
+    Args:
+      when: int of the index which indictaes time.
+      b: right-hand side vector.
+
+    Returns:
+      solution vector; least-squares (minimum norm) solution if C is singular.
+      Zero for stocks not in get_observed, all NaN if no stock is observed or the system is not finite.
+    """
+    observed = self.get_observed(when)
+    if not observed.any():
+      return np.full(len(b), np.nan)
+
+    x = np.zeros(len(b))
+    cho = self.get_cho_factor(when)
+    if cho is not None:
+      x[observed] = sp.linalg.cho_solve(cho, b[observed])
+    else:
+      _, covariance = self.get_moments(when)
+      covariance = covariance[np.ix_(observed, observed)]
+      if not (np.isfinite(covariance).all() and np.isfinite(b[observed]).all()):
+        return np.full(len(b), np.nan)
+      x[observed] = np.linalg.lstsq(covariance, b[observed], rcond=None)[0]
+    return x
+
   def gen_weight_zeros(self):
     """Generate dataframe filled with zeros which has same size of return
 
@@ -71,25 +277,17 @@ class StockData:
     Returns:
       pf_ret: dataframe of portfolio returns for backtesting period
     """
-    start_condition = self.ret.index > pd.to_datetime(start)
-    df_weight = self.gen_weight_zeros()
-    pf_ret = self.gen_return_zeros()
-
-    for cnt,idx in enumerate(self.ret.index):
-      if cnt == 0:
-          continue
-      
-      elif idx < pd.to_datetime(start):
-        continue
-
-      else:
-        target_weight = portfolio_function(cnt-1)
-        current_weight = (1+self.ret.loc[self.date_index[cnt-1]]) * df_weight.loc[self.date_index[cnt-1]]
-        current_weight = current_weight / current_weight.sum()
-        weight_difference = np.abs(target_weight - current_weight)
-
-        df_weight.loc[self.date_index[cnt]] = target_weight
-        pf_ret.loc[self.date_index[cnt],"pf_value"]  = (self.ret.loc[self.date_index[cnt]] * df_weight.loc[self.date_index[cnt]]).sum() 
-        pf_ret.loc[self.date_index[cnt],"pf_value"] -= (weight_difference.sum() * transaction_cost)
-        
-    return pf_ret[start_condition]
\ No newline at end of file
+    self._cho_when = -1
+    start_ts = pd.to_datetime(start)
+    start_pos = self._date_index.searchsorted(start_ts, side='right')
+    ret_arr = self._ret_values
+    W = np.zeros_like(ret_arr)
+    pf = np.zeros(len(self._date_index))
+
+    # the first month has no previous window and keeps a return of 0
+    for cnt in range(max(1, start_pos), len(self._date_index)):
+      target_weight = np.asarray(portfolio_function(cnt-1), dtype=np.float64)
+      pf[cnt] = _step(ret_arr[cnt-1], ret_arr[cnt], W[cnt-1], target_weight, float(transaction_cost))
+      W[cnt] = target_weight
+
+    return pd.DataFrame(pf[start_pos:], index=self._date_index[start_pos:], columns=["pf_value"])
\ No newline at end of file
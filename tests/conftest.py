@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PortfolioManagement.portfolio import Portfolio
+
+
+def load_crsp():
+  df = pd.read_csv(os.path.join(ROOT, "summative", "crsp-2.csv"), index_col=0)
+  df["date"] = pd.to_datetime(df["date"])
+  return df
+
+
+@pytest.fixture
+def crsp():
+  return load_crsp()
+
+
+@pytest.fixture
+def pf(crsp):
+  return Portfolio(data=crsp)
@@ -0,0 +1,246 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy as sp
+
+from PortfolioManagement import portfolio
+from PortfolioManagement.portfolio import Portfolio
+
+
+def test_robust_objective_zero_variance_is_nan(pf):
+  returns, covariance = pf.get_moments(50)
+  w = np.zeros_like(returns)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    assert np.isnan(portfolio.fobj_robust(w, returns, covariance, returns))
+    assert np.isnan(portfolio.jac_robust(w, returns, covariance, returns)).all()
+
+
+def test_step_skips_nan_terms():
+  from PortfolioManagement.stockdata import _step
+  r_prev = np.array([0.1, np.nan, 0.0])
+  r_curr = np.array([0.02, 0.01, np.nan])
+  W_prev = np.array([0.5, 0.25, 0.25])
+  tw = np.array([0.4, 0.3, 0.3])
+
+  drifted = np.array([0.55, np.nan, 0.25]) / 0.8
+  expected = 0.4 * 0.02 + 0.3 * 0.01 - np.nansum(np.abs(tw - drifted)) * 0.01
+  assert np.isclose(_step(r_prev, r_curr, W_prev, tw, 0.01), expected)
+  # no holdings yet: no transaction cost
+  assert np.isclose(_step(r_prev, r_curr, np.zeros(3), tw, 0.01), 0.4 * 0.02 + 0.3 * 0.01)
+
+
+def assert_moments_match(pf, when):
+  returns, covariance = pf.get_moments(when)
+  window = pf.get_ret_til(when)
+  np.testing.assert_allclose(returns, window.mean().values, rtol=1e-10, atol=1e-14)
+  np.testing.assert_allclose(covariance, window.cov().values, rtol=1e-8, atol=1e-14)
+  np.testing.assert_allclose(pf.get_std(when, ddof=0), np.std(window, axis=0).values, rtol=1e-8)
+
+
+def test_moments_match_pandas(pf):
+  # forward, backward (reset) and jump ahead
+  for when in [1, 2, 40, 41, 200, 10, 275]:
+    assert_moments_match(pf, when)
+
+
+def test_moments_skip_missing_returns(crsp):
+  crsp.loc[crsp.index[[5, 300, 301, 4000]], "ret"] = np.nan
+  pf = Portfolio(data=crsp)
+  for when in [20, 150, 275]:
+    assert_moments_match(pf, when)
+
+
+def test_rebalance_with_missing_return(crsp):
+  crsp.loc[crsp.index[[100, 270]], "ret"] = np.nan
+  pf = Portfolio(data=crsp)
+  for tc in [0, 0.002]:
+    pf_ret = pf.rebalance(pf.min_var, "2020", transaction_cost=tc)
+    assert pf_ret.shape == (36, 1)
+    assert np.isfinite(pf_ret.values).all()
+
+
+def test_equal_weight_cannot_be_modified(pf):
+  w = pf.equal_weight(3)
+  with pytest.raises(ValueError):
+    w *= 2
+  np.testing.assert_allclose(pf.equal_weight(4), 1 / 30)
+
+
+def test_value_weight_skips_missing_mktcap(crsp):
+  crsp.loc[crsp.index[10], "prc"] = np.nan
+  pf = Portfolio(data=crsp)
+  w = pf.value_weight(10)
+  assert np.isnan(w).sum() == 1
+  assert np.isclose(np.nansum(w), 1)
+
+
+def test_nested_rebalance_does_not_share_state(pf):
+  expected = pf.rebalance(pf.equal_weight, "2020", transaction_cost=0.002)
+
+  def nested(when):
+    pf.rebalance(pf.value_weight, "2021", transaction_cost=0.002)
+    return pf.equal_weight(when)
+
+  np.testing.assert_array_equal(pf.rebalance(nested, "2020", transaction_cost=0.002).values, expected.values)
+
+
+def test_cached_returns_are_read_only(pf):
+  with pytest.raises(ValueError):
+    pf._ret_values[0, 0] = 1.0
+
+
+@pytest.mark.filterwarnings("ignore:tangent portfolio does not exist")
+@pytest.mark.parametrize("name", ["mean_variance", "min_var"])
+def test_rebalance_short_window(pf, name):
+  # the first windows have fewer months than stocks, so the covariance is singular
+  assert pf.get_cho_factor(12) is None
+  pf_ret = pf.rebalance(getattr(pf, name), "2001")
+  assert np.isfinite(pf_ret.values).all()
+
+
+def sharpe(w, returns, covariance):
+  return (w @ returns) / np.sqrt(w @ covariance @ w)
+
+
+def test_mean_variance_matches_slsqp(pf):
+  # baseline: SLSQP on the Sharpe ratio with the budget constraint
+  when = 250
+  window = pf.get_ret_til(when)
+  returns, covariance = window.mean().values, window.cov().values
+  e = np.ones_like(returns)
+  res = sp.optimize.minimize(lambda w: -sharpe(w, returns, covariance), e / len(e),
+                             constraints=[dict(type='eq', fun=lambda w: w.sum() - 1)], options={'maxiter': 5000})
+
+  weight = pf.mean_variance(when)
+  assert np.isclose(weight.sum(), 1)
+  assert sharpe(weight, returns, covariance) >= sharpe(res.x, returns, covariance) - 1e-6
+  np.testing.assert_allclose(weight, res.x, atol=1e-2)
+
+
+def test_mean_variance_warns_without_tangent_portfolio(pf):
+  with pytest.warns(RuntimeWarning, match="tangent portfolio does not exist"):
+    pf.mean_variance(30)
+
+
+@pytest.fixture(params=["quadprog", "nnls"])
+def short_solver(request, monkeypatch):
+  if request.param == "quadprog":
+    pytest.importorskip("quadprog")
+  else:
+    monkeypatch.setattr(portfolio, "quadprog", None)
+  return request.param
+
+
+def test_short_constraint_short_window(pf, short_solver):
+  pf_ret = pf.rebalance(pf.mean_variance_short_constraint, "2001")
+  assert np.isfinite(pf_ret.values).all()
+
+
+def test_short_constraint_without_positive_mean(crsp, short_solver):
+  crsp["ret"] -= 1
+  pf = Portfolio(data=crsp)
+  with pytest.warns(RuntimeWarning, match="positive mean"):
+    weight = pf.mean_variance_short_constraint(100)
+  assert (weight == 1).sum() == 1 and weight.sum() == 1
+
+  # baseline SLSQP ends on the same single stock
+  window = pf.get_ret_til(100)
+  returns, covariance = window.mean().values, window.cov().values
+  expected = baseline_slsqp(lambda w: -sharpe(w, returns, covariance), len(returns),
+                            bounds=sp.optimize.Bounds(np.zeros_like(returns)))
+  assert sharpe(weight, returns, covariance) >= sharpe(expected, returns, covariance) - 1e-6
+
+def baseline_slsqp(fobj, n, bounds=None):
+  e = np.ones(n)
+  cons = [dict(type='eq', fun=lambda w: w.sum() - 1)]
+  return sp.optimize.minimize(fobj, e / n, constraints=cons, bounds=bounds, options={'maxiter': 5000}).x
+
+
+@pytest.mark.parametrize("when", [100, 250])
+def test_short_constraint_matches_slsqp(pf, short_solver, when):
+  window = pf.get_ret_til(when)
+  returns, covariance = window.mean().values, window.cov().values
+  expected = baseline_slsqp(lambda w: -sharpe(w, returns, covariance), len(returns),
+                            bounds=sp.optimize.Bounds(np.zeros_like(returns)))
+
+  weight = pf.mean_variance_short_constraint(when)
+  assert np.isclose(weight.sum(), 1) and (weight >= 0).all()
+  assert sharpe(weight, returns, covariance) >= sharpe(expected, returns, covariance) - 1e-6
+  np.testing.assert_allclose(weight, expected, atol=1e-3)
+
+
+def test_robust_matches_slsqp(pf):
+  when = 250
+  window = pf.get_ret_til(when)
+  returns, covariance = window.mean().values, window.cov().values
+  sigma = np.std(window, axis=0).values
+  fobj = lambda w: -(w @ returns - np.abs(w) @ sigma) / np.sqrt(w @ covariance @ w)
+  expected = baseline_slsqp(fobj, len(returns))
+
+  weight = pf.robust_optimization(when)
+  assert np.isclose(weight.sum(), 1)
+  assert fobj(weight) <= fobj(expected) + 1e-6
+
+
+def test_panels_reject_duplicate_entries(crsp):
+  duplicate = crsp.iloc[[0]].assign(ret=0.5)
+  with pytest.raises(ValueError, match="duplicate"):
+    Portfolio(data=pd.concat([crsp, duplicate]))
+
+
+@pytest.mark.parametrize("column", ["date", "permno"])
+def test_panels_reject_missing_keys(crsp, column):
+  crsp.loc[crsp.index[0], column] = np.nan
+  with pytest.raises(ValueError, match="must not be missing"):
+    Portfolio(data=crsp)
+
+
+@pytest.fixture
+def late_entry(crsp):
+  # one stock listed only from 2010
+  permno = crsp["permno"].iloc[0]
+  crsp = crsp[~((crsp["permno"] == permno) & (crsp["date"] < "2010-01-01"))]
+  return Portfolio(data=crsp), permno
+
+
+def test_moments_late_entry(late_entry):
+  pf, _ = late_entry
+  for when in [50, 120, 121, 275]:
+    assert_moments_match(pf, when)
+
+
+@pytest.mark.filterwarnings("ignore:tangent portfolio does not exist")
+@pytest.mark.parametrize("name", ["mean_variance", "mean_variance_short_constraint", "min_var", "robust_optimization"])
+def test_rebalance_late_entry(late_entry, name):
+  pf, permno = late_entry
+  col = pf.ret.columns.get_loc(permno)
+  listed = pf.ret.index.searchsorted(pd.Timestamp("2010-01-01"))
+
+  weight = getattr(pf, name)(listed)
+  assert not pf.get_observed(listed)[col]
+  assert weight[col] == 0 and np.isclose(weight.sum(), 1)
+  assert pf.get_observed(listed + 1)[col]
+
+  pf_ret = pf.rebalance(getattr(pf, name), "2005")
+  assert np.isfinite(pf_ret.values).all()
+
+
+@pytest.mark.filterwarnings("ignore:tangent portfolio does not exist")
+@pytest.mark.parametrize("start", ["1999", "2000", "2000-02"])
+@pytest.mark.parametrize("name", ["mean_variance", "mean_variance_short_constraint", "min_var", "robust_optimization"])
+def test_rebalance_from_first_month(pf, name, start):
+  # the first window has a single month, so no covariance is defined
+  assert not pf.get_observed(0).any()
+  assert pf.get_cho_factor(0) is None
+  assert np.isnan(pf.solve_covariance(0, np.ones(30))).all()
+
+  pf_ret = pf.rebalance(getattr(pf, name), start, transaction_cost=0.002)
+  assert np.isfinite(pf_ret.values).all()
+  assert pf_ret.index[-1] == pf.ret.index[-1]
+
+
+def test_rebalance_before_sample_keeps_first_month(pf):
+  pf_ret = pf.rebalance(pf.equal_weight, "2000")
+  assert pf_ret.shape == (276, 1)
+  assert pf_ret.iloc[0, 0] == 0
+  assert pf.rebalance(pf.equal_weight, "2020").shape == (36, 1)